@@ -4,13 +4,14 @@ import numpy as np
 import altair as alt
 import math
 import matplotlib.pyplot as plt
+from dataclasses import replace
 
 import logic
 import utils
 from db_manager import DBManager # Importiamo il nostro manager
 from data_models import (
     Sex, TrainingStatus, SportType, DietType, FatigueState, 
-    SleepQuality, MenstrualPhase, ChoMixType, Subject, IntakeMode
+    SleepQuality, MenstrualPhase, ChoMixType, Subject, IntakeMode, ActivityParams, DaySpec
 )
 
 
@@ -424,11 +425,11 @@ with tab1:
         
         st.divider()
         st.subheader("Analisi Tank")
-        max_cap = tank_data['max_capacity_g']
+        max_cap = tank_data.max_capacity_g
         c1, c2, c3 = st.columns(3)
         c1.metric("Capacità Totale", f"{int(max_cap)} g")
         c2.metric("Energia", f"{int(max_cap*4.1)} kcal")
-        c3.metric("Massa Attiva", f"{tank_data['active_muscle_kg']:.1f} kg")
+        c3.metric("Massa Attiva", f"{tank_data.active_muscle_kg:.1f} kg")
         st.progress(1.0)
         
         st.markdown("### Zone di Allenamento")
@@ -571,12 +572,12 @@ with tab2:
             "sleep_quality": new_sq
         })
         
-        input_result_data.append({
-            "date_obj": row['date_obj'],
-            "type": new_type, "val": new_val, "duration": new_dur, "calculated_if": calc_if,
-            "cho_in": new_cho, "sleep_factor": sleep_opts_map[new_sq],
-            "sleep_start": new_s_start, "sleep_end": new_s_end, "workout_start": new_w_start
-        })
+        input_result_data.append(DaySpec(
+            date_obj=row['date_obj'],
+            type=new_type, val=new_val, duration=new_dur, calculated_if=calc_if,
+            cho_in=new_cho, sleep_factor=sleep_opts_map[new_sq],
+            sleep_start=new_s_start, sleep_end=new_s_end, workout_start=new_w_start
+        ))
 
     st.markdown("---")
 
@@ -603,11 +604,11 @@ with tab2:
         st.altair_chart(chart, use_container_width=True)
         
         k1, k2, k3 = st.columns(3)
-        pct = final_tank['fill_pct']
+        pct = final_tank.fill_pct
         k1.metric("Riempimento Finale", f"{pct:.1f}%")
-        k2.metric("Muscolo Start Gara", f"{int(final_tank['muscle_glycogen_g'])} g")
-        k3.metric("Fegato Start Gara", f"{int(final_tank['liver_glycogen_g'])} g", 
-                  delta="Attenzione" if final_tank['liver_glycogen_g'] < 80 else "Ottimale", delta_color="normal")
+        k2.metric("Muscolo Start Gara", f"{int(final_tank.muscle_glycogen_g)} g")
+        k3.metric("Fegato Start Gara", f"{int(final_tank.liver_glycogen_g)} g", 
+                  delta="Attenzione" if final_tank.liver_glycogen_g < 80 else "Ottimale", delta_color="normal")
 # =============================================================================
 # TAB 3: SIMULAZIONE GARA & STRATEGIA (AGGIORNATO)
 # =============================================================================
@@ -623,18 +624,22 @@ with tab3:
     enable_override = st.checkbox("Abilita Override Livello Iniziale", value=False)
     
     if enable_override:
-        max_cap = tank_base['max_capacity_g']
+        max_cap = tank_base.max_capacity_g
         st.warning(f"Modalità Test Attiva. Max: {int(max_cap)}g")
         force_pct = st.slider("Forza Livello (%)", 0, 120, 100, 5)
-        tank = tank_base.copy()
-        tank['muscle_glycogen_g'] = (max_cap - 100) * (force_pct / 100.0)
-        tank['liver_glycogen_g'] = 100 * (force_pct / 100.0)
-        tank['actual_available_g'] = tank['muscle_glycogen_g'] + tank['liver_glycogen_g']
-        start_total = tank['actual_available_g']
+        forced_muscle = (max_cap - 100) * (force_pct / 100.0)
+        forced_liver = 100 * (force_pct / 100.0)
+        tank = replace(
+            tank_base,
+            muscle_glycogen_g=forced_muscle,
+            liver_glycogen_g=forced_liver,
+            actual_available_g=forced_muscle + forced_liver
+        )
+        start_total = tank.actual_available_g
         st.metric("Start Glicogeno", f"{int(start_total)} g")
     else:
         tank = tank_base
-        start_total = tank['actual_available_g']
+        start_total = tank.actual_available_g
         st.info(f"**Start Glicogeno (da Tab 2):** {int(start_total)}g")
     
     c_s1, c_s2, c_s3 = st.columns(3)
@@ -874,6 +879,8 @@ with tab3:
             min_w = min(w_bal_series)
             st.success(f"✅ **Tenuta Muscolare OK** (Minimo W': {int(min_w)} J)")
     # --- SELEZIONE MODALITÀ SIMULAZIONE ---
+    # Il dict params serve alla UI (costruzione incrementale + log); la logica riceve la versione tipizzata
+    activity = ActivityParams.from_dict(params)
     st.markdown("---")
     sim_mode = st.radio("Modalità Simulazione:", ["Simulazione Manuale (Verifica Tattica)", "Calcolatore Strategia Minima (Reverse)"], horizontal=True)
     cutoff_line = create_cutoff_line(duration - intake_cutoff)
@@ -883,7 +890,7 @@ with tab3:
         df_sim, stats_sim = logic.simulate_metabolism(
             tank, duration, cho_h, cho_unit, 
             crossover_val if not use_lab_active else 75, 
-            tau, subj, params, 
+            tau, subj, activity, 
             mix_type_input=mix_sel, 
             intensity_series=intensity_series,
             metabolic_curve=curve_data if use_lab_active else None,
@@ -899,7 +906,7 @@ with tab3:
         df_no, _ = logic.simulate_metabolism(
             tank, duration, 0, cho_unit, 
             crossover_val if not use_lab_active else 75, 
-            tau, subj, params, 
+            tau, subj, activity, 
             mix_type_input=mix_sel, 
             intensity_series=intensity_series,
             metabolic_curve=curve_data if use_lab_active else None,
@@ -1085,7 +1092,7 @@ with tab3:
         if st.button("Calcola Fabbisogno Minimo"):
              with st.spinner(f"Ottimizzazione con modello {'Mader' if use_mader_sim else 'Standard'}..."):
                  opt_intake = logic.calculate_minimum_strategy(
-                     tank, duration, subj, params, 
+                     tank, duration, subj, activity, 
                      curve_to_use, # <--- Passiamo la curva corretta (o None)
                      mix_sel, intake_mode_enum, intake_cutoff,
                      variability_index=vi_input, 
@@ -1111,7 +1118,7 @@ with tab3:
                  
                  # Scenario A: Il Crollo (0 g/h)
                  df_zero, stats_zero = logic.simulate_metabolism(
-                     tank, duration, 0, 0, 70, 20, subj, params, 
+                     tank, duration, 0, 0, 70, 20, subj, activity, 
                      mix_type_input=mix_sel, 
                      metabolic_curve=curve_to_use, # <--- Corretto
                      intake_mode=intake_mode_enum, intake_cutoff_min=intake_cutoff,
@@ -1123,7 +1130,7 @@ with tab3:
                  
                  # Scenario B: Il Salvataggio (opt_intake g/h)
                  df_opt, stats_opt = logic.simulate_metabolism(
-                     tank, duration, opt_intake, cho_unit if cho_unit > 0 else 25, 70, 20, subj, params, 
+                     tank, duration, opt_intake, cho_unit if cho_unit > 0 else 25, 70, 20, subj, activity, 
                      mix_type_input=mix_sel, 
                      metabolic_curve=curve_to_use, # <--- Corretto
                      intake_mode=intake_mode_enum, intake_cutoff_min=intake_cutoff,
@@ -1264,7 +1271,7 @@ with tab3:
         curr_gly_musc = row_sim['Residuo Muscolare']
         curr_gly_liv = row_sim['Residuo Epatico']
         # Recuperiamo il totale iniziale per calcolare la % corretta
-        start_gly_tot = tank['max_capacity_g'] 
+        start_gly_tot = tank.max_capacity_g 
         if 'start_total' in locals(): start_gly_tot = start_total
         
         curr_cons_tot = row_sim.get('Consumo Totale (g/h)', 0)
@@ -1353,11 +1360,11 @@ with tab3:
             "Soglia_HR": params.get('threshold_hr')
         },
         "2_TANK_INIZIALE": {
-            "Capacità_Max": int(tank['max_capacity_g']),
-            "Start_Totale": int(tank['actual_available_g']),
-            "Start_Muscolare": int(tank['muscle_glycogen_g']),
-            "Start_Epatico": int(tank['liver_glycogen_g']),
-            "Filling_PCT": tank['fill_pct']
+            "Capacità_Max": int(tank.max_capacity_g),
+            "Start_Totale": int(tank.actual_available_g),
+            "Start_Muscolare": int(tank.muscle_glycogen_g),
+            "Start_Epatico": int(tank.liver_glycogen_g),
+            "Filling_PCT": tank.fill_pct
         },
         "3_SFORZO": {
             "Durata_min": duration,
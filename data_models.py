@@ -1,5 +1,7 @@
 from enum import Enum
 from dataclasses import dataclass
+from datetime import date, time
+from typing import Optional
 
 class Sex(Enum):
     MALE = "Uomo"
@@ -140,3 +142,44 @@ class Subject:
             base += 0.03
         return base
 
+@dataclass(frozen=True, slots=True)
+class TankState:
+    """Stato dei serbatoi di glicogeno (output di calculate_tank / tapering)."""
+    active_muscle_kg: float
+    max_capacity_g: float
+    actual_available_g: float
+    muscle_glycogen_g: float
+    liver_glycogen_g: float
+    concentration_used: float
+    fill_pct: float
+    muscle_source_note: str
+
+@dataclass(frozen=True, slots=True)
+class ActivityParams:
+    """Parametri dello sforzo per la simulazione (np_watts None -> avg_watts)."""
+    mode: str = 'cycling'
+    avg_watts: float = 200
+    np_watts: Optional[float] = None
+    ftp_watts: float = 250
+    threshold_hr: float = 170
+    efficiency: float = 22.0
+    avg_hr: float = 150
+
+    @classmethod
+    def from_dict(cls, params: dict) -> "ActivityParams":
+        """Converte il dict costruito dalla UI; le chiavi assenti prendono il default."""
+        return cls(**{k: v for k, v in params.items() if k in cls.__dataclass_fields__})
+
+@dataclass(frozen=True, slots=True)
+class DaySpec:
+    """Un giorno del tapering: attività, nutrizione e orari (input di calculate_hourly_tapering)."""
+    date_obj: date
+    type: str
+    val: float
+    duration: float
+    calculated_if: float
+    cho_in: float
+    sleep_factor: float
+    sleep_start: time
+    sleep_end: time
+    workout_start: time
@@ -1,7 +1,30 @@
 import math
+from dataclasses import replace
+from functools import lru_cache
 import numpy as np
 import pandas as pd
-from data_models import Subject, Sex, ChoMixType, FatigueState, GlycogenState, IntakeMode, SportType
+try:
+    from numba import njit, prange
+except ImportError:
+    # Senza numba i kernel girano come Python puro: stessi risultati, più lenti
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+    prange = range
+from data_models import Subject, Sex, ChoMixType, FatigueState, GlycogenState, IntakeMode, SportType, TankState
+
+# --- 0. COSTANTI ---
+# Watt * min -> kcal a efficienza percentuale: kcal = W * _KCAL_PER_WATT_MIN_PCT / eff_pct
+# (raggruppa 60 / 4184 / (eff / 100) in un solo prodotto e una sola divisione)
+_KCAL_PER_WATT_MIN_PCT = 60.0 / 4184.0 * 100.0
+_INV_KCAL_PER_G_FAT = 1.0 / 9.0
+_INV_KCAL_PER_G_CHO = 1.0 / 4.1
+# Etichette della colonna "Stato" di simulate_metabolism (ordine = codici categorici)
+_SIM_STATUS_LABELS = ["Ottimale", "CRITICO (Ipoglicemia)", "Warning (Gambe Vuote)"]
+# Coefficienti RER(IF), dal grado 6 al termine noto
+_RER_POLY_COEFFS = np.array([-0.000000149, 141.538462237, -565.128206259, 890.333333976,
+                             -691.679487060, 265.460857558, -39.525121144])
 
 # --- 1. FUNZIONI HELPER ---
 
@@ -10,95 +33,141 @@ def get_concentration_from_vo2max(vo2_max):
     return max(12.0, min(26.0, conc))
 
 def calculate_rer_polynomial(intensity_factor):
-    if_val = intensity_factor
-    rer = (-0.000000149 * (if_val**6) + 141.538462237 * (if_val**5) - 565.128206259 * (if_val**4) + 
-           890.333333976 * (if_val**3) - 691.679487060 * (if_val**2) + 265.460857558 * if_val - 39.525121144)
-    return max(0.70, min(1.15, rer))
+    # Polinomio di 6° grado valutato in forma di Horner (accetta scalari o array)
+    rer = np.clip(np.polyval(_RER_POLY_COEFFS, intensity_factor), 0.70, 1.15)
+    return float(rer) if np.ndim(rer) == 0 else rer
 
 def calculate_depletion_factor(steps, activity_min, s_fatigue):
+    # steps e activity_min possono essere scalari o array (es. una settimana di giorni)
     steps_base = 10000 
     steps_factor = (steps - steps_base) / 5000 * 0.1 * 0.4
     activity_base = 120 
-    if activity_min < 60: 
-        activity_factor = (1 - (activity_min / 60)) * 0.05 * 0.6
-    else:
-        activity_factor = (activity_min - activity_base) / 60 * -0.1 * 0.6
+    activity_min = np.asarray(activity_min, dtype=float)
+    activity_factor = np.where(
+        activity_min < 60,
+        (1 - (activity_min / 60)) * 0.05 * 0.6,
+        (activity_min - activity_base) / 60 * -0.1 * 0.6
+    )
     depletion_impact = steps_factor + activity_factor
-    return max(0.6, min(1.0, 1.0 + depletion_impact))
+    depletion = np.clip(1.0 + depletion_impact, 0.6, 1.0)
+    return float(depletion) if np.ndim(depletion) == 0 else depletion
 
 def calculate_filling_factor_from_diet(weight_kg, cho_d1, cho_d2, s_fatigue, s_sleep, steps_m1, min_act_m1, steps_m2, min_act_m2):
     CHO_BASE_GK = 5.0
     CHO_MAX_GK = 10.0
     CHO_MIN_GK = 2.5
-    cho_d1_gk = max(cho_d1, 1.0) / weight_kg
-    cho_d2_gk = max(cho_d2, 1.0) / weight_kg
+    # Accetta scalari o array (es. coorte di soggetti / serie di giorni)
+    cho_d1_gk = np.maximum(cho_d1, 1.0) / weight_kg
+    cho_d2_gk = np.maximum(cho_d2, 1.0) / weight_kg
     avg_cho_gk = (cho_d1_gk * 0.7) + (cho_d2_gk * 0.3)
     
-    if avg_cho_gk >= CHO_MAX_GK: diet_factor = 1.25
-    elif avg_cho_gk >= CHO_BASE_GK: diet_factor = 1.0 + (avg_cho_gk - CHO_BASE_GK) * (0.25 / (CHO_MAX_GK - CHO_BASE_GK))
-    elif avg_cho_gk > CHO_MIN_GK: diet_factor = 0.5 + (avg_cho_gk - CHO_MIN_GK) * (0.5 / (CHO_BASE_GK - CHO_MIN_GK))
-    else: diet_factor = 0.5
-    
-    diet_factor = min(1.25, max(0.5, diet_factor))
+    # Spezzata continua 2.5 -> 0.5, 5 -> 1.0, 10 -> 1.25 g/kg (costante fuori dagli estremi)
+    diet_factor = np.interp(avg_cho_gk, [CHO_MIN_GK, CHO_BASE_GK, CHO_MAX_GK], [0.5, 1.0, 1.25])
     depletion = calculate_depletion_factor(steps_m1, min_act_m1, s_fatigue)
     final_filling = diet_factor * depletion * s_sleep.factor
-    return final_filling, diet_factor, avg_cho_gk, cho_d1_gk, cho_d2_gk
+    result = (final_filling, diet_factor, avg_cho_gk, cho_d1_gk, cho_d2_gk)
+    if np.ndim(final_filling) == 0:
+        return tuple(float(x) for x in result)
+    return result
 
-def calculate_tank(subject: Subject):
-    if subject.muscle_mass_kg is not None and subject.muscle_mass_kg > 0:
-        total_muscle = subject.muscle_mass_kg
-        muscle_source_note = "Massa Muscolare Misurata"
-    else:
-        lbm = subject.lean_body_mass
-        total_muscle = lbm * subject.muscle_fraction
-        muscle_source_note = "Massa Muscolare Stimata"
-
-    active_muscle = total_muscle * subject.sport.val
-    creatine_multiplier = 1.10 if subject.uses_creatine else 1.0
-    base_muscle_glycogen = active_muscle * subject.glycogen_conc_g_kg
+def _tank_formulas(muscle_mass, lbm, muscle_fraction, sport_factor, uses_creatine,
+                   glycogen_conc, filling_factor, menstrual_factor, glucose, liver_glycogen_g):
+    """
+    Formule del serbatoio, unica implementazione per calculate_tank e calculate_tank_batch.
+    Accetta scalari o array (S,); massa muscolare non misurata = NaN, glicemia assente = +inf.
+    """
+    has_measured_muscle = muscle_mass > 0  # NaN (non misurata) -> False
+    total_muscle = np.where(has_measured_muscle, muscle_mass, lbm * muscle_fraction)
+    active_muscle = total_muscle * sport_factor
+    creatine_multiplier = np.where(uses_creatine, 1.10, 1.0)
+    base_muscle_glycogen = active_muscle * glycogen_conc
     max_total_capacity = (base_muscle_glycogen * 1.25 * creatine_multiplier) + 100.0
-    final_filling_factor = subject.filling_factor * subject.menstrual_phase.factor
-    current_muscle_glycogen = base_muscle_glycogen * creatine_multiplier * final_filling_factor
-    max_physiological_limit = active_muscle * 35.0
-    if current_muscle_glycogen > max_physiological_limit: current_muscle_glycogen = max_physiological_limit
-    
-    liver_fill_factor = 1.0
-    if subject.filling_factor <= 0.6: liver_fill_factor = 0.6
-    if subject.glucose_mg_dl is not None:
-        if subject.glucose_mg_dl < 70: liver_fill_factor = 0.2
-        elif subject.glucose_mg_dl < 85: liver_fill_factor = min(liver_fill_factor, 0.5)
-    
-    current_liver_glycogen = subject.liver_glycogen_g * liver_fill_factor
+    final_filling_factor = filling_factor * menstrual_factor
+    current_muscle_glycogen = np.minimum(
+        base_muscle_glycogen * creatine_multiplier * final_filling_factor,
+        active_muscle * 35.0
+    )
+    
+    # Fegato: tetto da riempimento (<= 0.6) e da glicemia (< 70 -> 0.2, < 85 -> 0.5)
+    liver_ff_from_fill = np.where(filling_factor <= 0.6, 0.6, 1.0)
+    liver_ff_from_glucose = np.select([glucose < 70, glucose < 85], [0.2, 0.5], 1.0)
+    current_liver_glycogen = liver_glycogen_g * np.minimum(liver_ff_from_fill, liver_ff_from_glucose)
     total_actual_glycogen = current_muscle_glycogen + current_liver_glycogen
     
     return {
         "active_muscle_kg": active_muscle,
-        "max_capacity_g": max_total_capacity,         
-        "actual_available_g": total_actual_glycogen,   
+        "max_capacity_g": max_total_capacity,
+        "actual_available_g": total_actual_glycogen,
         "muscle_glycogen_g": current_muscle_glycogen,
         "liver_glycogen_g": current_liver_glycogen,
-        "concentration_used": subject.glycogen_conc_g_kg,
-        "fill_pct": (total_actual_glycogen / max_total_capacity) * 100 if max_total_capacity > 0 else 0,
-        "muscle_source_note": muscle_source_note
+        "concentration_used": glycogen_conc,
+        "fill_pct": np.divide(total_actual_glycogen * 100, max_total_capacity,
+                              out=np.zeros_like(max_total_capacity), where=max_total_capacity > 0),
+        "muscle_source_note": np.where(has_measured_muscle, "Massa Muscolare Misurata", "Massa Muscolare Stimata")
     }
 
+@lru_cache(maxsize=32)
+def _calculate_tank_cached(muscle_mass, lbm, muscle_fraction, sport_factor, uses_creatine,
+                           glycogen_conc, filling_factor, menstrual_factor, glucose, liver_glycogen_g):
+    # Stesse formule della versione batch su valori 0-d; TankState riceve float/str Python
+    tank = _tank_formulas(
+        np.nan if muscle_mass is None else muscle_mass, lbm, muscle_fraction, sport_factor, uses_creatine,
+        glycogen_conc, filling_factor, menstrual_factor, np.inf if glucose is None else glucose, liver_glycogen_g
+    )
+    note = str(tank.pop("muscle_source_note"))
+    return TankState(muscle_source_note=note, **{k: float(v) for k, v in tank.items()})
+
+def calculate_tank(subject: Subject):
+    # TankState è immutabile: il risultato è memorizzato sui soli campi del soggetto che lo determinano
+    return _calculate_tank_cached(
+        subject.muscle_mass_kg, subject.lean_body_mass, subject.muscle_fraction, subject.sport.val,
+        subject.uses_creatine, subject.glycogen_conc_g_kg, subject.filling_factor,
+        subject.menstrual_phase.factor, subject.glucose_mg_dl, subject.liver_glycogen_g
+    )
+
+def calculate_tank_batch(subjects):
+    """
+    Variante di calculate_tank su una lista di soggetti (analisi di sensibilità / confronti).
+    Stesse formule (_tank_formulas) in forma vettoriale; restituisce un dict di array (S,) con i campi di TankState.
+    """
+    def _col(values, dtype=np.float64):
+        return np.fromiter(values, dtype, len(subjects))
+    
+    return _tank_formulas(
+        _col((np.nan if s.muscle_mass_kg is None else s.muscle_mass_kg for s in subjects)),
+        _col((s.lean_body_mass for s in subjects)),
+        _col((s.muscle_fraction for s in subjects)),
+        _col((s.sport.val for s in subjects)),
+        _col((s.uses_creatine for s in subjects), np.bool_),
+        _col((s.glycogen_conc_g_kg for s in subjects)),
+        _col((s.filling_factor for s in subjects)),
+        _col((s.menstrual_phase.factor for s in subjects)),
+        _col((np.inf if s.glucose_mg_dl is None else s.glucose_mg_dl for s in subjects)),
+        _col((s.liver_glycogen_g for s in subjects)),
+    )
+
 def interpolate_consumption(current_val, curve_data):
     if isinstance(curve_data, pd.DataFrame):
         cho = np.interp(current_val, curve_data['Intensity'], curve_data['CHO'])
         fat = np.interp(current_val, curve_data['Intensity'], curve_data['FAT'])
         return cho, fat
     elif isinstance(curve_data, dict):
+        # Curva a 3 punti (Z2-Z4): stesse soglie in cascata della versione scalare, valutate
+        # elemento per elemento con np.select (nessuna ipotesi sull'ordine degli hr)
         p1, p2, p3 = curve_data['z2'], curve_data['z3'], curve_data['z4']
-        if current_val <= p1['hr']: return p1['cho'], p1['fat'] 
-        if current_val <= p2['hr']:
-            ratio = (current_val - p1['hr']) / (p2['hr'] - p1['hr'])
-            return p1['cho'] + ratio*(p2['cho']-p1['cho']), p1['fat'] + ratio*(p2['fat']-p1['fat'])
-        elif current_val <= p3['hr']:
-            ratio = (current_val - p2['hr']) / (p3['hr'] - p2['hr'])
-            return p2['cho'] + ratio*(p3['cho']-p2['cho']), p2['fat'] + ratio*(p3['fat']-p2['fat'])
-        else:
-            extra = current_val - p3['hr']
-            return p3['cho'] + (extra * 4.0), max(0.0, p3['fat'] - extra * 0.5)
+        v = np.asarray(current_val, dtype=float)
+        conds = [v <= p1['hr'], v <= p2['hr'], v <= p3['hr']]
+        extra = v - p3['hr']  # fuorigiri sopra Z4: estrapolazione lineare
+        with np.errstate(divide='ignore', invalid='ignore'):  # rami non selezionati con hr coincidenti
+            r12 = (v - p1['hr']) / (p2['hr'] - p1['hr'])
+            r23 = (v - p2['hr']) / (p3['hr'] - p2['hr'])
+            cho = np.select(conds, [p1['cho'], p1['cho'] + r12*(p2['cho']-p1['cho']),
+                                    p2['cho'] + r23*(p3['cho']-p2['cho'])], p3['cho'] + extra * 4.0)
+            fat = np.select(conds, [p1['fat'], p1['fat'] + r12*(p2['fat']-p1['fat']),
+                                    p2['fat'] + r23*(p3['fat']-p2['fat'])], np.maximum(0.0, p3['fat'] - extra * 0.5))
+        if v.ndim == 0:
+            return float(cho), float(fat)
+        return cho, fat
     return 0, 0
 
 def estimate_max_exogenous_oxidation(height_cm, weight_kg, ftp_watts, mix_type: ChoMixType):
@@ -111,11 +180,93 @@ def estimate_max_exogenous_oxidation(height_cm, weight_kg, ftp_watts, mix_type:
 
 # --- 2. MOTORE TAPERING (LOGICA ORARIA AVANZATA) ---
 
-def calculate_hourly_tapering(subject, days_data, start_state: GlycogenState = GlycogenState.NORMAL):
+@njit("Tuple((f8[:], f8[:]))(f8[:], f8[:], f8[:], b1[:], f8[:], f8, f8, f8, f8)", cache=True)
+def _run_taper_state(hourly_in, hourly_out_liver, hourly_out_muscle, is_working, efficiency,
+                     curr_muscle, curr_liver, max_muscle, max_liver):
+    """Aggiornamento orario dei serbatoi (riempimento con overflow / svuotamento) su flussi precalcolati."""
+    n_hours = hourly_in.shape[0]
+    muscle_log = np.empty(n_hours)
+    liver_log = np.empty(n_hours)
+    
+    for i in range(n_hours):
+        # --- CALCOLO NETTO ---
+        net_flow = hourly_in[i] - (hourly_out_liver[i] + hourly_out_muscle[i])
+        
+        # Applicazione ai serbatoi (Ripartizione)
+        if net_flow > 0:
+            # REFILLING (Priorità Muscolo 70/30)
+            # Se muscolo pieno, tutto a fegato (e viceversa)
+            real_storage = net_flow * efficiency[i]
+            
+            to_muscle = real_storage * 0.7
+            to_liver = real_storage * 0.3
+            
+            # Overflow Logic
+            if curr_muscle + to_muscle > max_muscle:
+                overflow = (curr_muscle + to_muscle) - max_muscle
+                to_muscle -= overflow
+                to_liver += overflow # Il fegato prova a prenderlo (lipogenesi dopo)
+            
+            curr_muscle = min(max_muscle, curr_muscle + to_muscle)
+            curr_liver = min(max_liver, curr_liver + to_liver)
+            
+        else:
+            # DRAINING
+            if is_working[i]:
+                # Il consumo è già diviso in hourly_out_...
+                # L'input copre prima il fegato (sangue), poi risparmia muscolo
+                curr_liver += hourly_in[i] - hourly_out_liver[i]
+                curr_muscle -= hourly_out_muscle[i]
+                
+            else:
+                # Deficit a riposo/sonno (Liver drain + NEAT)
+                # Il fegato copre quasi tutto a riposo
+                abs_deficit = abs(net_flow)
+                curr_liver -= (abs_deficit * 0.8)
+                curr_muscle -= (abs_deficit * 0.2)
+
+        # Clamping (Non sotto zero)
+        curr_muscle = max(0.0, curr_muscle)
+        curr_liver = max(0.0, curr_liver)
+        
+        muscle_log[i] = curr_muscle
+        liver_log[i] = curr_liver
+    
+    return muscle_log, liver_log
+
+def _clock_hours(t):
+    return t.hour + (t.minute / 60)
+
+def _days_to_columns(days_data) -> dict:
+    """
+    Converte la lista di giorni (DaySpec) in colonne contigue, una per campo.
+    Gli orari diventano ore decimali; le date restano oggetto per l'asse X.
+    """
+    n = len(days_data)
+    return {
+        'sleep_start': np.fromiter((_clock_hours(d.sleep_start) for d in days_data), np.float64, n),
+        'sleep_end': np.fromiter((_clock_hours(d.sleep_end) for d in days_data), np.float64, n),
+        'workout_start': np.fromiter((_clock_hours(d.workout_start) for d in days_data), np.float64, n),
+        'duration': np.fromiter((d.duration for d in days_data), np.float64, n),
+        'calculated_if': np.fromiter((d.calculated_if for d in days_data), np.float64, n),
+        'cho_in': np.fromiter((d.cho_in for d in days_data), np.float64, n),
+        'val': np.fromiter((d.val for d in days_data), np.float64, n),
+        'sleep_factor': np.fromiter((d.sleep_factor for d in days_data), np.float64, n),
+        'is_cycling': np.fromiter((d.type == 'Ciclismo' for d in days_data), np.bool_, n),
+        'date_obj': [d.date_obj for d in days_data],
+        'label': np.array([d.date_obj.strftime("%d/%m") for d in days_data], dtype=object),
+    }
+
+def _tapering_core(subject, days, start_state):
+    """
+    Parte numerica del tapering su colonne già estratte (_days_to_columns).
+    Restituisce status orario, serie muscolo/fegato (giorni*24) e TankState finale, senza DataFrame:
+    le analisi ripetute (sweep) possono chiamarla direttamente.
+    """
     
     # 1. Inizializzazione Serbatoi
     tank = calculate_tank(subject)
-    MAX_MUSCLE = tank['max_capacity_g'] - 100 
+    MAX_MUSCLE = tank.max_capacity_g - 100 
     MAX_LIVER = 100.0
     
     # Start level
@@ -123,196 +274,302 @@ def calculate_hourly_tapering(subject, days_data, start_state: GlycogenState = G
     curr_muscle = min(MAX_MUSCLE * start_factor, MAX_MUSCLE)
     curr_liver = min(MAX_LIVER * start_factor, MAX_LIVER)
     
-    hourly_log = []
-    
     # Costanti Fisiologiche Orarie
     LIVER_DRAIN_H = 4.0 # Consumo cervello/organi (g/h)
     NEAT_DRAIN_H = (1.0 * subject.weight_kg) / 16.0 # NEAT spalmato sulle 16h di veglia (g/h)
     
-    # Ciclo sui Giorni
-    for day_idx, day in enumerate(days_data):
-        date_label = day['date_obj'].strftime("%d/%m")
+    # --- MATRICI GIORNI x ORE ---
+    # Ogni riga è un giorno, ogni colonna un'ora (0-23): gli stati orari si calcolano in blocco
+    n_days = len(days['duration'])
+    hours = np.arange(24)
+    
+    def _day_column(key):
+        return days[key].reshape(n_days, 1)
+    
+    # Parsing Orari
+    sleep_start = _day_column('sleep_start')
+    sleep_end = _day_column('sleep_end')
+    work_start = _day_column('workout_start')
+    work_dur_h = _day_column('duration') / 60.0
+    work_end = work_start + work_dur_h
+    
+    # Check Sonno. Se sleep_start > sleep_end, scavalca la mezzanotte (es. 23:00 -> 07:00)
+    is_sleeping = np.where(
+        sleep_start > sleep_end,
+        (hours >= sleep_start) | (hours < sleep_end),
+        (sleep_start <= hours) & (hours < sleep_end)
+    )
+    # Check Allenamento (Prioritario sul sonno se configurato male)
+    is_working = (work_start <= hours) & (hours < work_end)
+    is_resting = ~is_sleeping & ~is_working
+    status = np.where(is_working, "WORK", np.where(is_sleeping, "SLEEP", "REST"))
+    
+    # Calcolo Ore di Veglia (Feeding Window) per distribuire il cibo
+    # Semplificazione: Assumiamo che si mangi uniformemente quando si è svegli e non ci si allena
+    waking_hours = is_resting.sum(axis=1, keepdims=True)
+    total_cho_input = _day_column('cho_in')
+    cho_rate_h = np.divide(total_cho_input, waking_hours, out=np.zeros_like(total_cho_input), where=waking_hours > 0)
+    
+    # Consumo lavoro (costante nelle ore di allenamento di ciascun giorno)
+    intensity = _day_column('calculated_if')
+    power = _day_column('val')
+    is_cycling = _day_column('is_cycling')
+    # Stima Kcal/h lavoro
+    kcal_work = np.where(is_cycling, (power * 60) / 4.184 / 0.22, 600 * intensity)
+    # CHO usage durante lavoro (dipende da intensità, usiamo stima RER macro)
+    # IF 0.6 -> 20% CHO, IF 0.8 -> 60% CHO, IF 0.9 -> 80% CHO
+    cho_pct = np.clip((intensity - 0.5) * 2.5, 0, 1.0)
+    g_cho_work = (kcal_work * cho_pct) / 4.1
+    
+    # Split consumo lavoro (Muscolo vs Fegato)
+    # Più è intenso, più usa muscolo
+    liver_share = 0.15 # Il fegato contribuisce sempre un po' sotto sforzo
+    
+    # --- BILANCIO ORARIO ---
+    # Sonno e lavoro: nessun intake (integrazione separata o nulla nel tapering)
+    hourly_in = np.where(is_resting, cho_rate_h, 0.0)
+    hourly_out_liver = LIVER_DRAIN_H + np.where(is_working, g_cho_work * liver_share, 0.0) # Sempre attivo (cervello)
+    hourly_out_muscle = np.where(is_working, g_cho_work * (1 - liver_share), np.where(is_resting, NEAT_DRAIN_H, 0.0))
+    
+    # Usiamo il fattore qualità del sonno del giorno PRECEDENTE/CORRENTE come efficienza metabolica generale
+    sleep_factor = np.repeat(days['sleep_factor'], 24)
+    
+    # Ciclo orario: il riempimento dipende dallo stato dell'ora precedente -> kernel compilato
+    muscle_log, liver_log = _run_taper_state(
+        hourly_in.ravel(), hourly_out_liver.ravel(), hourly_out_muscle.ravel(), is_working.ravel(),
+        sleep_factor, float(curr_muscle), float(curr_liver), float(MAX_MUSCLE), MAX_LIVER
+    )
+    if n_days > 0:
+        curr_muscle, curr_liver = float(muscle_log[-1]), float(liver_log[-1])
+
+    final_tank = replace(
+        tank,
+        muscle_glycogen_g=curr_muscle,
+        liver_glycogen_g=curr_liver,
+        actual_available_g=curr_muscle + curr_liver,
+        fill_pct=(curr_muscle + curr_liver) / (MAX_MUSCLE + MAX_LIVER) * 100
+    )
+    
+    return status.ravel(), muscle_log, liver_log, final_tank
+
+def calculate_hourly_tapering(subject, days_data, start_state: GlycogenState = GlycogenState.NORMAL):
+    days = _days_to_columns(days_data)
+    status, muscle_log, liver_log, final_tank = _tapering_core(subject, days, start_state)
+    
+    # Costruzione Timestamp per Grafico
+    # Usiamo un datetime fittizio o reale per l'asse X
+    n_days = len(days_data)
+    hours = np.arange(24)
+    day_starts = pd.to_datetime(days['date_obj'])
+    
+    hourly_log = pd.DataFrame({
+        "Timestamp": day_starts.repeat(24) + pd.to_timedelta(np.tile(hours, n_days), unit='h'),
+        "Giorno": np.repeat(days['label'], 24),
+        "Ora": np.tile(hours, n_days),
+        "Status": status,
+        "Muscolare": muscle_log,
+        "Epatico": liver_log,
+        "Totale": muscle_log + liver_log,
+        "Zona": np.where(liver_log > 20, "Sicura", "Rischio")
+    }, copy=False)  # colonne già allocate qui: pandas usa direttamente i buffer
+    
+    return hourly_log, final_tank
+
+# funzione simulazione metabolica
+
+def _substrate_demand_empirical(t_axis, current_vals, metabolic_curve):
+    """
+    Motore empirico (curva da laboratorio).
+    Restituisce per ogni minuto (array): CHO (g/min), FAT (g/min), quota CHO e RER.
+    """
+    cho_rate_gh, fat_rate_gh = interpolate_consumption(current_vals, metabolic_curve)
+    
+    # Drift dopo la prima ora (fattore 1.0 fino a t=60)
+    minutes_over = np.maximum(t_axis - 60, 0)
+    cho_rate_gh = cho_rate_gh * (1.0 + minutes_over * 0.0006)
+    fat_rate_gh = fat_rate_gh * (1.0 - minutes_over * 0.0003)
+    
+    n = len(t_axis)
+    return cho_rate_gh / 60.0, fat_rate_gh / 60.0, np.ones(n), np.full(n, 0.85)
+
+def _substrate_demand_mader(current_vals, kcal_demands, subject_obj, mode, running_method):
+    """
+    Motore teorico Mader (VO2max / VLaMax).
+    Restituisce per ogni minuto (array): CHO (g/min), FAT (g/min), quota CHO e RER.
+    """
+    mader_watts_input = current_vals # Default Ciclismo
+    
+    # Logica Specifica Corsa
+    if mode == 'running':
+        # A. STRADA FISIOLOGICA (HR -> Kcal -> Watt Equivalenti)
+        if running_method == "PHYSIOLOGICAL":
+             # Invertiamo la formula delle Kcal per trovare i Watt equivalenti allo sforzo cardiaco
+             # Kcal/min = (Watts * 0.01433) / 0.21 (Efficienza Corsa)
+             mader_watts_input = (kcal_demands * 0.21) / 0.01433
         
-        # Parsing Orari
-        sleep_start = day['sleep_start'].hour + (day['sleep_start'].minute/60)
-        sleep_end = day['sleep_end'].hour + (day['sleep_end'].minute/60)
-        # Gestione notte (es. 23:00 -> 07:00). Se sleep_start > sleep_end, scavalca la mezzanotte
+        # B. STRADA MECCANICA (Speed -> Watt)
+        else:
+            # Input > 50 già in Watt (Stryd), altrimenti km/h -> Watt
+            # Formula approx: Peso * Speed(m/s) * Costo(J/kg/m ~1.04)
+            speed_ms = current_vals / 3.6
+            mader_watts_input = np.where(current_vals > 50, current_vals, speed_ms * subject_obj.weight_kg * 1.04)
+
+    # Calcolo Mader Puro con Watt (reali o stimati)
+    total_cho_demand = calculate_mader_consumption(mader_watts_input, subject_obj) + np.zeros_like(kcal_demands)
+    
+    # Calcola grassi per differenza calorica
+    # Usiamo le Kcal calcolate dal modello HR (kcal_demands) per coerenza col dispendio totale
+    kcal_cho = total_cho_demand * 4.0
+    kcal_fat = np.maximum(0, kcal_demands - kcal_cho)
+    
+    # Stima parametri per output
+    cho_ratios = np.divide(kcal_cho, kcal_demands, out=np.ones_like(kcal_demands), where=kcal_demands > 0)
+    
+    return total_cho_demand, kcal_fat * _INV_KCAL_PER_G_FAT, cho_ratios, 0.7 + (0.3 * cho_ratios)
+
+def _substrate_demand_crossover(t_axis, current_ifs, kcal_demands, crossover_pct):
+    """
+    Motore teorico standard (Crossover + polinomio RER).
+    Restituisce per ogni minuto (array): CHO (g/min), FAT (g/min), quota CHO e RER.
+    """
+    standard_crossover = 75.0 
+    crossover_val = crossover_pct if crossover_pct else standard_crossover
+    if_shift = (standard_crossover - crossover_val) / 100.0
+    
+    effective_if_for_rer = np.maximum(0.3, current_ifs + if_shift)
+    
+    rers = calculate_rer_polynomial(effective_if_for_rer)
+    base_cho_ratio = np.clip((rers - 0.70) * 3.45, 0.0, 1.0)
+    
+    # Shift metabolico verso i grassi dopo la prima ora (solo sotto IF 0.85)
+    hours_past = np.maximum(t_axis - 60, 0) / 60.0
+    metabolic_shift = 0.05 * (hours_past ** 1.2) 
+    fat_shift_mask = (current_ifs < 0.85) & (t_axis > 60)
+    cho_ratios = np.where(fat_shift_mask, np.maximum(0.05, base_cho_ratio - metabolic_shift), base_cho_ratio)
+    
+    kcal_cho_demand = kcal_demands * cho_ratios
+    fat_demand = np.where(kcal_demands > 0, kcal_demands * (1.0 - cho_ratios) * _INV_KCAL_PER_G_FAT, 0.0)
+    
+    return kcal_cho_demand * _INV_KCAL_PER_G_CHO, fat_demand, cho_ratios, rers
+
+# Firme esplicite: compilazione (o caricamento dalla cache su disco) all'import, non alla prima simulazione
+_STATE_SERIES_1D = "Tuple((f4[:], f4[:], f4[:], f4[:], f4[:], f4[:], f4[:]))"
+_STATE_SERIES_2D = "Tuple((f4[:, :], f4[:, :], f4[:, :], f4[:, :], f4[:, :], f4[:, :], f4[:, :]))"
+
+@njit(_STATE_SERIES_1D + "(f8, f8, b1, f8[:], f8[:], f8, f8, f8)", cache=True, fastmath=True)
+def _run_state(alpha, effective_target, is_input_zero, intake_g_min, cho_demands,
+               oxidation_efficiency, initial_muscle_glycogen, initial_liver_glycogen):
+    """
+    Ricorrenza minuto per minuto: ossidazione esogena (EMA), carico intestinale
+    e svuotamento di muscolo/fegato. È l'unica parte con dipendenza sequenziale.
+    Lo stato corre in float64; le serie in uscita sono float32 (precisione ampiamente
+    sufficiente per grammi al minuto, metà della memoria).
+    """
+    n_steps = intake_g_min.shape[0]
+    exo_oxidation = np.empty(n_steps, dtype=np.float32)
+    gut_load = np.empty(n_steps, dtype=np.float32)
+    muscle_usage = np.empty(n_steps, dtype=np.float32)
+    liver_usage = np.empty(n_steps, dtype=np.float32)
+    exo_usage = np.empty(n_steps, dtype=np.float32)
+    muscle_left = np.empty(n_steps, dtype=np.float32)
+    liver_left = np.empty(n_steps, dtype=np.float32)
+    
+    current_exo_oxidation_g_min = 0.0
+    gut_accumulation_total = 0.0
+    current_muscle_glycogen = initial_muscle_glycogen
+    current_liver_glycogen = initial_liver_glycogen
+    
+    # Invarianti del ciclo
+    decay = 1.0 - alpha
+    inv_initial_muscle = 1.0 / initial_muscle_glycogen if initial_muscle_glycogen > 0 else 0.0
+    max_liver_output = 1.2 
+    
+    for t in range(n_steps):
+        if is_input_zero:
+            current_exo_oxidation_g_min *= decay
+        else:
+            current_exo_oxidation_g_min += alpha * (effective_target - current_exo_oxidation_g_min)
         
-        work_start = day['workout_start'].hour + (day['workout_start'].minute/60)
-        work_dur_h = day['duration'] / 60.0
-        work_end = work_start + work_dur_h
+        current_exo_oxidation_g_min = max(0.0, current_exo_oxidation_g_min)
         
-        total_cho_input = day['cho_in']
+        gut_accumulation_total += (intake_g_min[t] * oxidation_efficiency)
+        real_oxidation = min(current_exo_oxidation_g_min, gut_accumulation_total)
+        current_exo_oxidation_g_min = real_oxidation
+        gut_accumulation_total -= real_oxidation
+        if gut_accumulation_total < 0: gut_accumulation_total = 0.0
         
-        # Calcolo Ore di Veglia (Feeding Window) per distribuire il cibo
-        # Semplificazione: Assumiamo che si mangi uniformemente quando si è svegli e non ci si allena
-        waking_hours = 0
-        for h in range(24):
-            is_sleeping = False
-            if sleep_start > sleep_end: # Scavalca notte (es 23-07)
-                if h >= sleep_start or h < sleep_end: is_sleeping = True
-            else:
-                if sleep_start <= h < sleep_end: is_sleeping = True
-            
-            is_working = (work_start <= h < work_end)
-            if not is_sleeping and not is_working:
-                waking_hours += 1
+        # --- RIPARTIZIONE GLICOGENO ---
+        total_cho_g_min = cho_demands[t]
+        muscle_fill_state = current_muscle_glycogen * inv_initial_muscle
+        muscle_contribution_factor = math.pow(muscle_fill_state, 0.6) 
+        muscle_usage_g_min = total_cho_g_min * muscle_contribution_factor
+        if current_muscle_glycogen <= 0: muscle_usage_g_min = 0.0
         
-        cho_rate_h = total_cho_input / waking_hours if waking_hours > 0 else 0
+        blood_glucose_demand_g_min = total_cho_g_min - muscle_usage_g_min
+        from_exogenous = min(blood_glucose_demand_g_min, current_exo_oxidation_g_min)
+        remaining_blood_demand = blood_glucose_demand_g_min - from_exogenous
+        from_liver = min(remaining_blood_demand, max_liver_output)
+        if current_liver_glycogen <= 0: from_liver = 0.0
         
-        # Ciclo sulle 24 ore del giorno
-        for h in range(24):
-            status = "REST"
-            is_sleeping = False
-            
-            # Check Sonno
-            if sleep_start > sleep_end:
-                if h >= sleep_start or h < sleep_end: is_sleeping = True
-            else:
-                if sleep_start <= h < sleep_end: is_sleeping = True
-            
-            if is_sleeping: status = "SLEEP"
-            
-            # Check Allenamento (Prioritario sul sonno se configurato male)
-            if work_start <= h < work_end:
-                status = "WORK"
-            
-            # --- BILANCIO ORARIO ---
-            hourly_in = 0
-            hourly_out_liver = LIVER_DRAIN_H # Sempre attivo (cervello)
-            hourly_out_muscle = 0
-            
-            if status == "SLEEP":
-                hourly_in = 0 # Non mangi mentre dormi
-                # Sintesi facilitata durante il sonno (se c'è surplus precedente, ma qui è real time)
-            
-            elif status == "WORK":
-                hourly_in = 0 # Assumiamo integrazione separata o nulla nel tapering
-                # Calcolo consumo lavoro
-                intensity = day.get('calculated_if', 0)
-                # Stima Kcal/h lavoro
-                kcal_work = (day.get('val', 0) * 60) / 4.184 / 0.22 if day.get('type') == 'Ciclismo' else 600 * intensity
-                # CHO usage durante lavoro (dipende da intensità, usiamo stima RER macro)
-                # IF 0.6 -> 20% CHO, IF 0.8 -> 60% CHO, IF 0.9 -> 80% CHO
-                cho_pct = max(0, (intensity - 0.5) * 2.5) 
-                cho_pct = min(1.0, cho_pct)
-                g_cho_work = (kcal_work * cho_pct) / 4.1
-                
-                # Split consumo lavoro (Muscolo vs Fegato)
-                # Più è intenso, più usa muscolo
-                liver_share = 0.15 # Il fegato contribuisce sempre un po' sotto sforzo
-                hourly_out_muscle = g_cho_work * (1 - liver_share)
-                hourly_out_liver += g_cho_work * liver_share
-                
-            elif status == "REST":
-                hourly_in = cho_rate_h
-                hourly_out_muscle = NEAT_DRAIN_H # Piccolo consumo per muoversi
-            
-            # --- CALCOLO NETTO ---
-            net_flow = hourly_in - (hourly_out_liver + hourly_out_muscle)
-            
-            # Applicazione ai serbatoi (Ripartizione)
-            if net_flow > 0:
-                # REFILLING (Priorità Muscolo 70/30)
-                # Se muscolo pieno, tutto a fegato (e viceversa)
-                
-                # Efficienza assorbimento (Sonno penalizza se fosse attivo, ma qui siamo svegli)
-                # Usiamo il fattore qualità del sonno del giorno PRECEDENTE/CORRENTE come efficienza metabolica generale
-                efficiency = day['sleep_factor'] 
-                real_storage = net_flow * efficiency
-                
-                to_muscle = real_storage * 0.7
-                to_liver = real_storage * 0.3
-                
-                # Overflow Logic
-                if curr_muscle + to_muscle > MAX_MUSCLE:
-                    overflow = (curr_muscle + to_muscle) - MAX_MUSCLE
-                    to_muscle -= overflow
-                    to_liver += overflow # Il fegato prova a prenderlo (lipogenesi dopo)
-                
-                curr_muscle = min(MAX_MUSCLE, curr_muscle + to_muscle)
-                curr_liver = min(MAX_LIVER, curr_liver + to_liver)
-                
-            else:
-                # DRAINING
-                # Se stiamo lavorando, abbiamo già diviso out_muscle e out_liver
-                # Se è deficit basale, lo dividiamo 50/50 o attingiamo al fegato
-                
-                abs_deficit = abs(net_flow)
-                
-                if status == "WORK":
-                    # Il consumo è già diviso in hourly_out_...
-                    # Ma hourly_in potrebbe coprire parte. Semplifichiamo:
-                    # Applichiamo i consumi diretti
-                    # L'input copre prima il fegato (sangue), poi risparmia muscolo
-                    
-                    # Ricalcolo flussi separati con intake
-                    # Intake supporta prima il fegato (glicemia)
-                    liver_balance = (hourly_in) - hourly_out_liver
-                    if liver_balance < 0:
-                        curr_liver += liver_balance # Scende
-                    else:
-                        # Surplus epatico momentaneo protegge muscolo? No, va a scorte o ossidazione
-                        curr_liver += liver_balance # Sale o pari
-                        
-                    curr_muscle -= hourly_out_muscle
-                    
-                else:
-                    # Deficit a riposo/sonno (Liver drain + NEAT)
-                    # Il fegato copre quasi tutto a riposo
-                    curr_liver -= (abs_deficit * 0.8)
-                    curr_muscle -= (abs_deficit * 0.2)
-
-            # Clamping (Non sotto zero)
-            curr_muscle = max(0, curr_muscle)
-            curr_liver = max(0, curr_liver)
-            
-            # Costruzione Timestamp per Grafico
-            # Usiamo un datetime fittizio o reale per l'asse X
-            ts = pd.Timestamp(day['date_obj']) + pd.Timedelta(hours=h)
+        # Update Riserve
+        if t > 0:
+            current_muscle_glycogen -= muscle_usage_g_min
+            current_liver_glycogen -= from_liver
             
-            hourly_log.append({
-                "Timestamp": ts,
-                "Giorno": date_label,
-                "Ora": h,
-                "Status": status,
-                "Muscolare": curr_muscle,
-                "Epatico": curr_liver,
-                "Totale": curr_muscle + curr_liver,
-                "Zona": "Sicura" if curr_liver > 20 else "Rischio"
-            })
-
-    final_tank = tank.copy()
-    final_tank['muscle_glycogen_g'] = curr_muscle
-    final_tank['liver_glycogen_g'] = curr_liver
-    final_tank['actual_available_g'] = curr_muscle + curr_liver
-    final_tank['fill_pct'] = (curr_muscle + curr_liver) / (MAX_MUSCLE + MAX_LIVER) * 100
-    
-    return pd.DataFrame(hourly_log), final_tank
-
-# funzione simulazione metabolica
+            if current_muscle_glycogen < 0: current_muscle_glycogen = 0.0
+            if current_liver_glycogen < 0: current_liver_glycogen = 0.0
+        
+        exo_oxidation[t] = current_exo_oxidation_g_min
+        gut_load[t] = gut_accumulation_total
+        muscle_usage[t] = muscle_usage_g_min
+        liver_usage[t] = from_liver
+        exo_usage[t] = from_exogenous
+        muscle_left[t] = current_muscle_glycogen
+        liver_left[t] = current_liver_glycogen
+    
+    return exo_oxidation, gut_load, muscle_usage, liver_usage, exo_usage, muscle_left, liver_left
 
-def simulate_metabolism(subject_data, duration_min, constant_carb_intake_g_h, cho_per_unit_g, crossover_pct, 
-                        tau_absorption, subject_obj, activity_params, oxidation_efficiency_input=0.80, 
-                        custom_max_exo_rate=None, mix_type_input=ChoMixType.GLUCOSE_ONLY, 
-                        intensity_series=None, metabolic_curve=None, 
-                        intake_mode=IntakeMode.DISCRETE, intake_cutoff_min=0, variability_index=1.0, 
-                        use_mader=False, running_method="PHYSIOLOGICAL"):
+@njit(_STATE_SERIES_2D + "(f8[:], f8[:], b1[:], f8[:, :], f8[:], f8[:], f8, f8)", cache=True, parallel=True)
+def _run_state_batch(alphas, effective_targets, zero_inputs, intake_g_min, cho_demands,
+                     oxidation_efficiencies, initial_muscle_glycogen, initial_liver_glycogen):
+    """_run_state su S scenari (righe di intake_g_min), in parallelo."""
+    n_scenarios, n_steps = intake_g_min.shape
+    exo_oxidation = np.empty((n_scenarios, n_steps), dtype=np.float32)
+    gut_load = np.empty((n_scenarios, n_steps), dtype=np.float32)
+    muscle_usage = np.empty((n_scenarios, n_steps), dtype=np.float32)
+    liver_usage = np.empty((n_scenarios, n_steps), dtype=np.float32)
+    exo_usage = np.empty((n_scenarios, n_steps), dtype=np.float32)
+    muscle_left = np.empty((n_scenarios, n_steps), dtype=np.float32)
+    liver_left = np.empty((n_scenarios, n_steps), dtype=np.float32)
     
-    results = []
-    initial_muscle_glycogen = subject_data['muscle_glycogen_g']
-    current_muscle_glycogen = initial_muscle_glycogen
-    current_liver_glycogen = subject_data['liver_glycogen_g']
+    for s in prange(n_scenarios):
+        out = _run_state(alphas[s], effective_targets[s], zero_inputs[s], intake_g_min[s], cho_demands,
+                         oxidation_efficiencies[s], initial_muscle_glycogen, initial_liver_glycogen)
+        exo_oxidation[s] = out[0]
+        gut_load[s] = out[1]
+        muscle_usage[s] = out[2]
+        liver_usage[s] = out[3]
+        exo_usage[s] = out[4]
+        muscle_left[s] = out[5]
+        liver_left[s] = out[6]
     
+    return exo_oxidation, gut_load, muscle_usage, liver_usage, exo_usage, muscle_left, liver_left
+
+def _energy_demand(duration_min, subject_obj, activity_params, crossover_pct, intensity_series,
+                   metabolic_curve, variability_index, use_mader, running_method):
+    """
+    Domanda energetica minuto per minuto (indipendente dallo stato dei serbatoi e dall'intake).
+    Restituisce asse dei tempi, IF istantaneo, IF di riferimento e gli array del motore substrati.
+    """
     # PARAMETRI ATTIVITÀ
-    avg_watts = activity_params.get('avg_watts', 200)
-    np_watts = activity_params.get('np_watts', avg_watts)
-    ftp_watts = activity_params.get('ftp_watts', 250)
+    avg_watts = activity_params.avg_watts
+    np_watts = activity_params.np_watts if activity_params.np_watts is not None else avg_watts
+    ftp_watts = activity_params.ftp_watts
     
-    threshold_hr = activity_params.get('threshold_hr', 170)
-    gross_efficiency = activity_params.get('efficiency', 22.0)
-    mode = activity_params.get('mode', 'cycling')
-    avg_hr = activity_params.get('avg_hr', 150)
+    threshold_hr = activity_params.threshold_hr
+    gross_efficiency = activity_params.efficiency
+    mode = activity_params.mode
+    avg_hr = activity_params.avg_hr
     
     threshold_ref = ftp_watts if mode == 'cycling' else threshold_hr
     base_val = avg_watts if mode == 'cycling' else avg_hr
@@ -327,7 +584,7 @@ def simulate_metabolism(subject_data, duration_min, constant_carb_intake_g_h, ch
     # --- FIX RUNNING: CALCOLO KCAL BASE ---
     if mode == 'cycling':
         # Ciclismo: Fisica pura (Watt -> Kcal)
-        kcal_per_min_base = (avg_watts * 60) / 4184 / (gross_efficiency / 100.0)
+        kcal_per_min_base = avg_watts * _KCAL_PER_WATT_MIN_PCT / gross_efficiency
     else:
         # Running: Stima basata su VO2max invece che formula generica
         # Assumiamo che la Soglia (HR Threshold) sia al 90% del VO2max
@@ -344,289 +601,286 @@ def simulate_metabolism(subject_data, duration_min, constant_carb_intake_g_h, ch
         
     is_lab_data = True if metabolic_curve is not None else False 
     
-    if custom_max_exo_rate is not None:
-        max_exo_rate_g_min = custom_max_exo_rate 
+    n_steps = int(duration_min) + 1
+    t_axis = np.arange(n_steps)
+    
+    # Determine Current Intensity
+    current_vals = np.full(n_steps, base_val, dtype=float)
+    if variability_index > 1.0:
+        current_ifs = np.full(n_steps, intensity_factor_reference * variability_index)
+    else:
+        current_ifs = np.full(n_steps, intensity_factor_reference, dtype=float)
+    
+    if intensity_series is not None:
+        series = np.asarray(intensity_series, dtype=float)[:n_steps]
+        n_series = len(series)
+        current_vals[:n_series] = series
+        current_ifs[:n_series] = series / threshold_ref if threshold_ref > 0 else 0.8
+    
+    # Calcolo Domanda Energetica Istantanea
+    if mode == 'cycling':
+        # Calo di efficienza dopo la prima ora (minimo 15%)
+        current_eff = np.where(t_axis > 60, np.maximum(15.0, gross_efficiency - (t_axis - 60) * 0.02), gross_efficiency)
+        kcal_demands = current_vals * _KCAL_PER_WATT_MIN_PCT / current_eff
+    else: 
+        # Running: Drift cardiaco (aumento costo apparente)
+        drift_factor = 1.0 + np.maximum(t_axis - 60, 0) * 0.0005
+        demand_scaling = current_ifs / intensity_factor_reference if intensity_factor_reference > 0 else 1.0
+        kcal_demands = kcal_per_min_base * drift_factor * demand_scaling
+    
+    # --- CONSUMO SUBSTRATI ---
+    # Il motore è invariante nel tempo: lo scegliamo una sola volta invece che ad ogni minuto
+    if is_lab_data:
+        cho_demands, fat_demands, cho_ratios, rers = _substrate_demand_empirical(t_axis, current_vals, metabolic_curve)
+    elif use_mader:
+        # --- INTEGRAZIONE MADER (AVANZATA) ---
+        cho_demands, fat_demands, cho_ratios, rers = _substrate_demand_mader(
+            current_vals, kcal_demands, subject_obj, mode, running_method
+        )
     else:
-        max_exo_rate_g_min = estimate_max_exogenous_oxidation(
-            subject_obj.height_cm, subject_obj.weight_kg, ftp_watts, mix_type_input
+        # LOGICA STANDARD (CROSSOVER)
+        cho_demands, fat_demands, cho_ratios, rers = _substrate_demand_crossover(
+            t_axis, current_ifs, kcal_demands, crossover_pct
         )
     
-    gut_accumulation_total = 0.0
-    current_exo_oxidation_g_min = 0.0 
-    alpha = 1 - np.exp(-1.0 / tau_absorption)
-    total_muscle_used = 0.0
-    total_liver_used = 0.0
-    total_exo_used = 0.0
-    total_fat_burned_g = 0.0
-    total_intake_cumulative = 0.0
-    total_exo_oxidation_cumulative = 0.0
-    
-    units_per_hour = constant_carb_intake_g_h / cho_per_unit_g if cho_per_unit_g > 0 else 0
-    intake_interval_min = round(60 / units_per_hour) if units_per_hour > 0 else duration_min + 1
-    is_input_zero = constant_carb_intake_g_h == 0
+    return t_axis, current_ifs, intensity_factor_reference, cho_demands, fat_demands, cho_ratios, rers
+
+def _max_exo_rate(subject_obj, activity_params, custom_max_exo_rate, mix_type_input):
+    if custom_max_exo_rate is not None:
+        return custom_max_exo_rate 
+    return estimate_max_exogenous_oxidation(
+        subject_obj.height_cm, subject_obj.weight_kg, activity_params.ftp_watts, mix_type_input
+    )
+
+@lru_cache(maxsize=64)
+def _absorption_alpha(tau_absorption):
+    # Coefficiente dell'EMA di ossidazione esogena per la costante di assorbimento tau (min)
+    return 1 - math.exp(-1.0 / tau_absorption)
+
+def _intake_schedule(n_steps, duration_min, constant_carb_intake_g_h, cho_per_unit_g, intake_mode, intake_cutoff_min):
+    """CHO ingeriti per minuto (g/min): unità discrete o flusso continuo entro la finestra di alimentazione."""
+    intake_g_min = np.zeros(n_steps)
+    if constant_carb_intake_g_h == 0:
+        return intake_g_min
     
-    # Loop Temporale
-    for t in range(int(duration_min) + 1):
-        
-        # Determine Current Intensity
-        current_val = base_val
-        current_if_moment = intensity_factor_reference
-
-        if intensity_series is not None and t < len(intensity_series):
-            current_val = intensity_series[t]
-            current_if_moment = current_val / threshold_ref if threshold_ref > 0 else 0.8
-        elif variability_index > 1.0:
-             current_if_moment *= variability_index
-        
-        # Calcolo Domanda Energetica Istantanea
-        current_kcal_demand = 0.0
-        if mode == 'cycling':
-            instant_power = current_val
-            current_eff = gross_efficiency
-            if t > 60: 
-                loss = (t - 60) * 0.02
-                current_eff = max(15.0, gross_efficiency - loss)
-            current_kcal_demand = (instant_power * 60) / 4184 / (current_eff / 100.0)
-        else: 
-            # Running: Drift cardiaco (aumento costo apparente)
-            drift_factor = 1.0
-            if t > 60: drift_factor += (t - 60) * 0.0005 
-            demand_scaling = current_if_moment / intensity_factor_reference if intensity_factor_reference > 0 else 1.0
-            current_kcal_demand = kcal_per_min_base * drift_factor * demand_scaling
-        
-        # --- INTAKE ---
-        instantaneous_input_g_min = 0.0 
-        in_feeding_window = t <= (duration_min - intake_cutoff_min)
-        
-        is_discrete = False
-        try:
-             if intake_mode and intake_mode.name == 'DISCRETE': is_discrete = True
-        except: pass
-
-        if not is_input_zero and in_feeding_window:
-            if is_discrete:
-                if t == 0 or (t > 0 and intake_interval_min > 0 and t % intake_interval_min == 0):
-                    instantaneous_input_g_min = cho_per_unit_g 
-            else:
-                instantaneous_input_g_min = constant_carb_intake_g_h / 60.0
-        
-        # Exogenous Oxidation Logic
-        user_intake_rate = constant_carb_intake_g_h / 60.0 
-        effective_target = min(user_intake_rate, max_exo_rate_g_min) * oxidation_efficiency_input
-        if is_input_zero: effective_target = 0.0
+    is_discrete = False
+    try:
+         if intake_mode and intake_mode.name == 'DISCRETE': is_discrete = True
+    except: pass
+    
+    # Finestra di alimentazione: minuti 0 .. (durata - cutoff) inclusi
+    feeding_end = min(n_steps, max(0, math.floor(duration_min - intake_cutoff_min) + 1))
+    if is_discrete:
+        units_per_hour = constant_carb_intake_g_h / cho_per_unit_g if cho_per_unit_g > 0 else 0
+        intake_interval_min = round(60 / units_per_hour) if units_per_hour > 0 else duration_min + 1
+        # Un'unità al minuto 0 e poi ogni intake_interval_min minuti
+        intake_step = int(intake_interval_min) if intake_interval_min > 0 else n_steps
+        intake_g_min[:feeding_end:intake_step] = cho_per_unit_g
+    else:
+        intake_g_min[:feeding_end] = constant_carb_intake_g_h / 60.0
+    return intake_g_min
 
-        if t >= 0:
-            if is_input_zero:
-                current_exo_oxidation_g_min *= (1 - alpha) 
-            else:
-                current_exo_oxidation_g_min += alpha * (effective_target - current_exo_oxidation_g_min)
-            
-            current_exo_oxidation_g_min = max(0.0, current_exo_oxidation_g_min)
-            
-            gut_accumulation_total += (instantaneous_input_g_min * oxidation_efficiency_input)
-            real_oxidation = min(current_exo_oxidation_g_min, gut_accumulation_total)
-            current_exo_oxidation_g_min = real_oxidation
-            gut_accumulation_total -= real_oxidation
-            if gut_accumulation_total < 0: gut_accumulation_total = 0 
-            
-            total_intake_cumulative += instantaneous_input_g_min 
-            total_exo_oxidation_cumulative += current_exo_oxidation_g_min
-        
-        # --- CONSUMO SUBSTRATI ---
-        cho_ratio = 1.0
-        rer = 0.85
-        total_cho_demand = 0.0
-        g_fat = 0.0
-
-        if is_lab_data:
-            cho_rate_gh, fat_rate_gh = interpolate_consumption(current_val, metabolic_curve)
-            if t > 60:
-                drift = 1.0 + ((t - 60) * 0.0006)
-                cho_rate_gh *= drift
-                fat_rate_gh *= (1.0 - ((t - 60) * 0.0003))
-            total_cho_demand = cho_rate_gh / 60.0
-            g_fat = fat_rate_gh / 60.0
-            rer = 0.85 
-        else:
-            # --- INTEGRAZIONE MADER (AVANZATA) ---
-            if use_mader:
-                mader_watts_input = current_val # Default Ciclismo
-                
-                # Logica Specifica Corsa
-                if mode == 'running':
-                    # A. STRADA FISIOLOGICA (HR -> Kcal -> Watt Equivalenti)
-                    if running_method == "PHYSIOLOGICAL":
-                         # Invertiamo la formula delle Kcal per trovare i Watt equivalenti allo sforzo cardiaco
-                         # Kcal/min = (Watts * 0.01433) / 0.21 (Efficienza Corsa)
-                         mader_watts_input = (current_kcal_demand * 0.21) / 0.01433
-                    
-                    # B. STRADA MECCANICA (Speed -> Watt)
-                    else:
-                        if current_val > 50: # Input già in Watt (Stryd)
-                             mader_watts_input = current_val
-                        else:
-                             # Input in km/h -> Watt
-                             speed_ms = current_val / 3.6
-                             # Formula approx: Peso * Speed(m/s) * Costo(J/kg/m ~1.04)
-                             mader_watts_input = speed_ms * subject_obj.weight_kg * 1.04
-
-                # Calcolo Mader Puro con Watt (reali o stimati)
-                mader_cho_g_min = calculate_mader_consumption(mader_watts_input, subject_obj)
-                total_cho_demand = mader_cho_g_min
-                
-                # Calcola grassi per differenza calorica
-                # Usiamo le Kcal calcolate dal modello HR (current_kcal_demand) per coerenza col dispendio totale
-                kcal_cho = total_cho_demand * 4.0
-                kcal_fat = max(0, current_kcal_demand - kcal_cho)
-                g_fat = kcal_fat / 9.0
-                
-                # Stima parametri per output
-                if current_kcal_demand > 0:
-                    cho_ratio = kcal_cho / current_kcal_demand
-                rer = 0.7 + (0.3 * cho_ratio)
-            else:
-                # LOGICA STANDARD (CROSSOVER)
-                standard_crossover = 75.0 
-                crossover_val = crossover_pct if crossover_pct else standard_crossover
-                if_shift = (standard_crossover - crossover_val) / 100.0
-                effective_if_for_rer = max(0.3, current_if_moment + if_shift)
-                
-                rer = calculate_rer_polynomial(effective_if_for_rer)
-                base_cho_ratio = (rer - 0.70) * 3.45
-                base_cho_ratio = max(0.0, min(1.0, base_cho_ratio))
-                
-                current_cho_ratio = base_cho_ratio
-                if current_if_moment < 0.85 and t > 60:
-                    hours_past = (t - 60) / 60.0
-                    metabolic_shift = 0.05 * (hours_past ** 1.2) 
-                    current_cho_ratio = max(0.05, base_cho_ratio - metabolic_shift)
-                
-                cho_ratio = current_cho_ratio
-                kcal_cho_demand = current_kcal_demand * cho_ratio
-                total_cho_demand = kcal_cho_demand / 4.1
-                g_fat = (current_kcal_demand * (1.0-cho_ratio) / 9.0) if current_kcal_demand > 0 else 0
-        
-        total_cho_g_min = total_cho_demand
-        
-        # --- RIPARTIZIONE GLICOGENO ---
-        muscle_fill_state = current_muscle_glycogen / initial_muscle_glycogen if initial_muscle_glycogen > 0 else 0
-        muscle_contribution_factor = math.pow(muscle_fill_state, 0.6) 
-        muscle_usage_g_min = total_cho_g_min * muscle_contribution_factor
-        if current_muscle_glycogen <= 0: muscle_usage_g_min = 0
-        
-        blood_glucose_demand_g_min = total_cho_g_min - muscle_usage_g_min
-        from_exogenous = min(blood_glucose_demand_g_min, current_exo_oxidation_g_min)
-        remaining_blood_demand = blood_glucose_demand_g_min - from_exogenous
-        max_liver_output = 1.2 
-        from_liver = min(remaining_blood_demand, max_liver_output)
-        if current_liver_glycogen <= 0: from_liver = 0
-        
-        # Update Riserve
-        if t > 0:
-            current_muscle_glycogen -= muscle_usage_g_min
-            current_liver_glycogen -= from_liver
-            
-            if current_muscle_glycogen < 0: current_muscle_glycogen = 0
-            if current_liver_glycogen < 0: current_liver_glycogen = 0
-            
-            total_fat_burned_g += g_fat
-            total_muscle_used += muscle_usage_g_min
-            total_liver_used += from_liver
-            total_exo_used += from_exogenous
-        
-        status_label = "Ottimale"
-        if current_liver_glycogen < 20: status_label = "CRITICO (Ipoglicemia)"
-        elif current_muscle_glycogen < 100: status_label = "Warning (Gambe Vuote)"
-        
-        total_g_min = max(1.0, muscle_usage_g_min + from_liver + from_exogenous + g_fat)
-        
-        results.append({
-            "Time (min)": t,
-            "Glicogeno Muscolare (g)": muscle_usage_g_min * 60, 
-            "Glicogeno Epatico (g)": from_liver * 60,
-            "Carboidrati Esogeni (g)": from_exogenous * 60, 
-            "Ossidazione Lipidica (g)": g_fat * 60,
-            "Pct_Muscle": f"{(muscle_usage_g_min / total_g_min * 100):.1f}%",
-            "Pct_Liver": f"{(from_liver / total_g_min * 100):.1f}%",
-            "Pct_Exo": f"{(from_exogenous / total_g_min * 100):.1f}%",
-            "Pct_Fat": f"{(g_fat / total_g_min * 100):.1f}%",
-            "Residuo Muscolare": current_muscle_glycogen,
-            "Residuo Epatico": current_liver_glycogen,
-            "Residuo Totale": current_muscle_glycogen + current_liver_glycogen,
-            "Target Intake (g/h)": constant_carb_intake_g_h,
-            "Gut Load": gut_accumulation_total,
-            "Stato": status_label,
-            "CHO %": cho_ratio * 100,
-            "Intake Cumulativo (g)": total_intake_cumulative,
-            "Ossidazione Cumulativa (g)": total_exo_oxidation_cumulative,
-            "Intensity Factor (IF)": current_if_moment
-        })
+def simulate_metabolism(subject_data, duration_min, constant_carb_intake_g_h, cho_per_unit_g, crossover_pct, 
+                        tau_absorption, subject_obj, activity_params, oxidation_efficiency_input=0.80, 
+                        custom_max_exo_rate=None, mix_type_input=ChoMixType.GLUCOSE_ONLY, 
+                        intensity_series=None, metabolic_curve=None, 
+                        intake_mode=IntakeMode.DISCRETE, intake_cutoff_min=0, variability_index=1.0, 
+                        use_mader=False, running_method="PHYSIOLOGICAL"):
+    """Simulazione minuto per minuto di serbatoi, intestino e ossidazione."""
+    
+    # --- DOMANDA ENERGETICA (indipendente dallo stato dei serbatoi) ---
+    t_axis, current_ifs, intensity_factor_reference, cho_demands, fat_demands, cho_ratios, rers = _energy_demand(
+        duration_min, subject_obj, activity_params, crossover_pct, intensity_series,
+        metabolic_curve, variability_index, use_mader, running_method
+    )
+    n_steps = len(t_axis)
     
-    # Statistiche Finali
-    total_kcal_final = (avg_watts * duration_min * 60) / 4184 / (gross_efficiency/100)
-    final_total_glycogen = current_muscle_glycogen + current_liver_glycogen
+    # --- INTAKE ---
+    intake_g_min = _intake_schedule(
+        n_steps, duration_min, constant_carb_intake_g_h, cho_per_unit_g, intake_mode, intake_cutoff_min
+    )
+    
+    # Exogenous Oxidation Logic
+    max_exo_rate_g_min = _max_exo_rate(subject_obj, activity_params, custom_max_exo_rate, mix_type_input)
+    alpha = _absorption_alpha(tau_absorption)
+    is_input_zero = constant_carb_intake_g_h == 0
+    user_intake_rate = constant_carb_intake_g_h / 60.0 
+    effective_target = min(user_intake_rate, max_exo_rate_g_min) * oxidation_efficiency_input
+    if is_input_zero: effective_target = 0.0
+    
+    # Loop Temporale (solo la parte con stato: intestino e serbatoi) -> kernel compilato
+    exo_oxidation, gut_load, muscle_usage, liver_usage, exo_usage, muscle_left, liver_left = _run_state(
+        alpha, float(effective_target), is_input_zero, intake_g_min, cho_demands,
+        float(oxidation_efficiency_input), float(subject_data.muscle_glycogen_g), float(subject_data.liver_glycogen_g)
+    )
+    
+    # Statistiche Finali (il minuto 0 non scala le riserve)
+    total_kcal_final = activity_params.avg_watts * duration_min * _KCAL_PER_WATT_MIN_PCT / activity_params.efficiency
+    final_total_glycogen = float(muscle_left[-1]) + float(liver_left[-1])
     
     stats = {
         "final_glycogen": final_total_glycogen,
-        "total_muscle_used": total_muscle_used,
-        "total_liver_used": total_liver_used,
-        "total_exo_used": total_exo_used,
-        "fat_total_g": total_fat_burned_g,
+        "total_muscle_used": float(muscle_usage[1:].sum(dtype=np.float64)),
+        "total_liver_used": float(liver_usage[1:].sum(dtype=np.float64)),
+        "total_exo_used": float(exo_usage[1:].sum(dtype=np.float64)),
+        "fat_total_g": float(fat_demands[1:].sum()),
+        "kcal_total_h": total_kcal_final,
+        "intensity_factor": intensity_factor_reference,
+        "avg_rer": float(rers[-1]),
+        "cho_pct": float(cho_ratios[-1]) * 100,
+        "min_liver": float(liver_left.min()),
+        "min_muscle": float(muscle_left.min())
+    }
+    
+    # Tre soli stati possibili: colonna categorica (codici int8) invece di N stringhe
+    status_label = pd.Categorical.from_codes(
+        np.where(liver_left < 20, 1, np.where(muscle_left < 100, 2, 0)).astype(np.int8),
+        categories=_SIM_STATUS_LABELS
+    )
+    
+    # Colonne solo per grafici/tabelle in float32 (come le serie di stato); le statistiche restano in float64
+    total_g_min = np.maximum(1.0, muscle_usage + liver_usage + exo_usage + fat_demands)
+    
+    results = pd.DataFrame({
+        "Time (min)": t_axis,
+        "Glicogeno Muscolare (g)": muscle_usage * 60, 
+        "Glicogeno Epatico (g)": liver_usage * 60,
+        "Carboidrati Esogeni (g)": exo_usage * 60, 
+        "Ossidazione Lipidica (g)": (fat_demands * 60).astype(np.float32),
+        # Quote percentuali numeriche: la formattazione ("12.3%") spetta a chi le visualizza
+        "Pct_Muscle": (muscle_usage / total_g_min * 100).astype(np.float32),
+        "Pct_Liver": (liver_usage / total_g_min * 100).astype(np.float32),
+        "Pct_Exo": (exo_usage / total_g_min * 100).astype(np.float32),
+        "Pct_Fat": (fat_demands / total_g_min * 100).astype(np.float32),
+        "Residuo Muscolare": muscle_left,
+        "Residuo Epatico": liver_left,
+        "Residuo Totale": muscle_left + liver_left,
+        "Target Intake (g/h)": constant_carb_intake_g_h,
+        "Gut Load": gut_load,
+        "Stato": status_label,
+        "CHO %": (cho_ratios * 100).astype(np.float32),
+        "Intake Cumulativo (g)": np.cumsum(intake_g_min).astype(np.float32),
+        "Ossidazione Cumulativa (g)": np.cumsum(exo_oxidation, dtype=np.float64).astype(np.float32),
+        "Intensity Factor (IF)": current_ifs.astype(np.float32)
+    }, copy=False)  # colonne già allocate qui: pandas usa direttamente i buffer
+    return results, stats
+
+def simulate_metabolism_batch(subject_data, duration_min, carb_intakes_g_h, cho_per_unit_g, crossover_pct, 
+                              tau_absorptions, subject_obj, activity_params, oxidation_efficiencies=0.80, 
+                              custom_max_exo_rate=None, mix_type_input=ChoMixType.GLUCOSE_ONLY, 
+                              intensity_series=None, metabolic_curve=None, 
+                              intake_mode=IntakeMode.DISCRETE, intake_cutoff_min=0, variability_index=1.0, 
+                              use_mader=False, running_method="PHYSIOLOGICAL"):
+    """
+    Variante "what-if" di simulate_metabolism su S scenari in un solo passaggio.
+    carb_intakes_g_h, tau_absorptions e oxidation_efficiencies accettano scalari o array (S,).
+    La domanda energetica è comune e si calcola una volta; la ricorrenza gira in parallelo sugli scenari.
+    Restituisce un dict di array per minuto (S, N) e un dict di statistiche per scenario (S,).
+    """
+    carb_intakes_g_h, tau_absorptions, oxidation_efficiencies = (
+        np.array(x, dtype=float) for x in np.broadcast_arrays(
+            np.atleast_1d(carb_intakes_g_h), np.atleast_1d(tau_absorptions), np.atleast_1d(oxidation_efficiencies)
+        )
+    )
+    
+    # --- DOMANDA ENERGETICA (comune a tutti gli scenari) ---
+    t_axis, current_ifs, intensity_factor_reference, cho_demands, fat_demands, cho_ratios, rers = _energy_demand(
+        duration_min, subject_obj, activity_params, crossover_pct, intensity_series,
+        metabolic_curve, variability_index, use_mader, running_method
+    )
+    n_steps = len(t_axis)
+    
+    # --- INTAKE (una riga per scenario) ---
+    intake_g_min = np.zeros((len(carb_intakes_g_h), n_steps))
+    for i, carb_g_h in enumerate(carb_intakes_g_h.tolist()):
+        intake_g_min[i] = _intake_schedule(n_steps, duration_min, carb_g_h, cho_per_unit_g, intake_mode, intake_cutoff_min)
+    
+    max_exo_rate_g_min = _max_exo_rate(subject_obj, activity_params, custom_max_exo_rate, mix_type_input)
+    alphas = 1 - np.exp(-1.0 / tau_absorptions)
+    zero_inputs = carb_intakes_g_h == 0
+    effective_targets = np.where(
+        zero_inputs, 0.0, np.minimum(carb_intakes_g_h / 60.0, max_exo_rate_g_min) * oxidation_efficiencies
+    )
+    
+    exo_oxidation, gut_load, muscle_usage, liver_usage, exo_usage, muscle_left, liver_left = _run_state_batch(
+        alphas, effective_targets, zero_inputs, intake_g_min, np.ascontiguousarray(cho_demands, dtype=float),
+        oxidation_efficiencies, float(subject_data.muscle_glycogen_g), float(subject_data.liver_glycogen_g)
+    )
+    
+    results = {
+        "Time (min)": t_axis,
+        "Glicogeno Muscolare (g)": muscle_usage * 60, 
+        "Glicogeno Epatico (g)": liver_usage * 60,
+        "Carboidrati Esogeni (g)": exo_usage * 60, 
+        "Ossidazione Lipidica (g)": (fat_demands * 60).astype(np.float32),
+        "Residuo Muscolare": muscle_left,
+        "Residuo Epatico": liver_left,
+        "Residuo Totale": muscle_left + liver_left,
+        "Gut Load": gut_load,
+        "CHO %": (cho_ratios * 100).astype(np.float32),
+        "Intake Cumulativo (g)": np.cumsum(intake_g_min, axis=1).astype(np.float32),
+        "Ossidazione Cumulativa (g)": np.cumsum(exo_oxidation, axis=1, dtype=np.float64).astype(np.float32),
+        "Intensity Factor (IF)": current_ifs.astype(np.float32)
+    }
+    
+    total_kcal_final = activity_params.avg_watts * duration_min * _KCAL_PER_WATT_MIN_PCT / activity_params.efficiency
+    
+    stats = {
+        "final_glycogen": muscle_left[:, -1].astype(np.float64) + liver_left[:, -1],
+        "min_liver": liver_left.min(axis=1),
+        "min_muscle": muscle_left.min(axis=1),
+        "total_muscle_used": muscle_usage[:, 1:].sum(axis=1, dtype=np.float64),
+        "total_liver_used": liver_usage[:, 1:].sum(axis=1, dtype=np.float64),
+        "total_exo_used": exo_usage[:, 1:].sum(axis=1, dtype=np.float64),
+        "fat_total_g": float(fat_demands[1:].sum()),
         "kcal_total_h": total_kcal_final,
         "intensity_factor": intensity_factor_reference,
-        "avg_rer": rer,
-        "cho_pct": cho_ratio * 100
+        "avg_rer": float(rers[-1]),
+        "cho_pct": float(cho_ratios[-1]) * 100
     }
-    return pd.DataFrame(results), stats
+    return results, stats
 
 # --- 4. CALCOLO REVERSE STRATEGY ---
 
-# --- 4. CALCOLO REVERSE STRATEGY (AGGIORNATA) ---
-
 def calculate_minimum_strategy(tank, duration, subj, params, curve_data, mix_type, intake_mode, intake_cutoff_min=0, variability_index=1.0, intensity_series=None, use_mader=False, running_method="PHYSIOLOGICAL"):
     """
     Calcola la strategia nutrizionale minima necessaria.
-    Itera simulazioni aumentando l'intake finché i serbatoi non rimangono sopra la soglia di sicurezza.
+    Simula tutta la griglia di intake in un solo passaggio (domanda energetica, alpha e
+    ossidazione massima calcolati una volta) e restituisce il primo intake che tiene
+    i serbatoi sopra la soglia di sicurezza.
     """
-    optimal = None
-    
     # Definiamo i limiti di sicurezza (Stop prima di svuotare tutto)
     MIN_LIVER_SAFE = 5.0   # Grammi minimi fegato
     MIN_MUSCLE_SAFE = 20.0 # Grammi minimi muscolo
     
-    # Iteriamo l'intake da 0 a 120 g/h con step di 5g
-    for intake in range(0, 125, 5):
-        
-        # Eseguiamo la simulazione passando TUTTI i parametri, incluso running_method
-        df, stats = simulate_metabolism(
-            subject_data=tank, 
-            duration_min=duration, 
-            constant_carb_intake_g_h=intake, 
-            cho_per_unit_g=30, # Valore dummy per il calcolo continuo
-            crossover_pct=75,  # Valore dummy se usiamo Mader
-            tau_absorption=20, 
-            subject_obj=subj, 
-            activity_params=params, 
-            mix_type_input=mix_type, 
-            metabolic_curve=curve_data,
-            intake_mode=intake_mode, 
-            intake_cutoff_min=intake_cutoff_min,
-            variability_index=variability_index,
-            intensity_series=intensity_series,
-            use_mader=use_mader,          # <--- Fondamentale
-            running_method=running_method # <--- NUOVO: Passa la modalità Corsa
-        )
-        
-        # Verifichiamo i minimi raggiunti durante la gara
-        min_liver = df['Residuo Epatico'].min()
-        min_muscle = df['Residuo Muscolare'].min()
-        
-        # Criterio di successo: Non andiamo mai sotto i minimi di sicurezza
-        if min_liver > MIN_LIVER_SAFE and min_muscle > MIN_MUSCLE_SAFE:
-            optimal = intake
-            break
-            
-    return optimal
+    # Griglia intake da 0 a 120 g/h con step di 5g
+    intake_grid = np.arange(0, 125, 5)
+    
+    # Eseguiamo le simulazioni passando TUTTI i parametri, incluso running_method
+    _, stats = simulate_metabolism_batch(
+        subject_data=tank, 
+        duration_min=duration, 
+        carb_intakes_g_h=intake_grid, 
+        cho_per_unit_g=30, # Valore dummy per il calcolo continuo
+        crossover_pct=75,  # Valore dummy se usiamo Mader
+        tau_absorptions=20, 
+        subject_obj=subj, 
+        activity_params=params, 
+        mix_type_input=mix_type, 
+        metabolic_curve=curve_data,
+        intake_mode=intake_mode, 
+        intake_cutoff_min=intake_cutoff_min,
+        variability_index=variability_index,
+        intensity_series=intensity_series,
+        use_mader=use_mader,          # <--- Fondamentale
+        running_method=running_method # <--- NUOVO: Passa la modalità Corsa
+    )
+    
+    # Criterio di successo: Non andiamo mai sotto i minimi di sicurezza
+    safe = (stats['min_liver'] > MIN_LIVER_SAFE) & (stats['min_muscle'] > MIN_MUSCLE_SAFE)
+    if not safe.any():
+        return None
+    return int(intake_grid[np.argmax(safe)])
 # ==============================================================================
 # MODULO MORTON / SKIBA (W' BALANCE)
 # ==============================================================================
@@ -682,7 +936,7 @@ def calculate_w_prime_balance(intensity_series, cp_watts, w_prime_j, sampling_in
 def calculate_mader_consumption(watts, subject: Subject, custom_efficiency=None):
     """
     Calcola il consumo di CHO (g/min) basato su VO2max e VLaMax.
-    Supporta efficienza personalizzata.
+    Supporta efficienza personalizzata. Accetta Watt scalari o array NumPy.
     """
     # 0. Costanti di Calibrazione
     VLA_SCALE = 0.07
@@ -710,12 +964,12 @@ def calculate_mader_consumption(watts, subject: Subject, custom_efficiency=None)
     
     # 3. Produzione Lattato (Systemic Appearance)
     # VLaMax * 60 * Intensity^3 * Scala
-    raw_prod = (subject.vlamax * 60) * (max(0, intensity) ** 3)
+    raw_prod = (subject.vlamax * 60) * (np.maximum(0, intensity) ** 3)
     vla_prod = raw_prod * VLA_SCALE
     
     # 4. Combustione Lattato (Clearance)
     # La capacità di smaltimento dipende dal VO2 effettivo (mitocondri attivi)
-    vo2_uptake = min(vo2_demand_ml, vo2_max_abs)
+    vo2_uptake = np.minimum(vo2_demand_ml, vo2_max_abs)
     vla_comb = K_COMB * (vo2_uptake / subject.weight_kg)
     
     net_balance = vla_prod - vla_comb
@@ -725,9 +979,9 @@ def calculate_mader_consumption(watts, subject: Subject, custom_efficiency=None)
     base_rer = 0.70 + (0.18 * intensity) 
     
     # Lactate Push: Il lattato spinge il metabolismo verso i CHO, ma ora è scalato
-    lactate_push = min(0.25, vla_prod * 0.15)
+    lactate_push = np.minimum(0.25, vla_prod * 0.15)
     
-    final_rer = min(1.0, max(0.7, base_rer + lactate_push))
+    final_rer = np.clip(base_rer + lactate_push, 0.7, 1.0)
     
     cho_pct = (final_rer - 0.7) / 0.3
     cho_aerobic = (kcal_min * cho_pct) / 4.0
@@ -736,7 +990,7 @@ def calculate_mader_consumption(watts, subject: Subject, custom_efficiency=None)
     # Aggiungiamo solo i carboidrati "persi" come lattato non ossidato (sopra soglia)
     # Se net_balance < 0 (sotto soglia), il costo è zero (tutto ossidato e conteggiato in RER)
     vol_dist = subject.weight_kg * 0.40
-    cho_anaerobic = max(0, net_balance) * vol_dist * 0.09
+    cho_anaerobic = np.maximum(0, net_balance) * vol_dist * 0.09
     
     return cho_aerobic + cho_anaerobic
 
@@ -1,6 +1,8 @@
 import streamlit as st
 import xml.etree.ElementTree as ET
+import csv
 import math
+from functools import lru_cache
 import pandas as pd
 import numpy as np
 import io
@@ -252,22 +254,40 @@ def parse_fit_file_wrapper(uploaded_file, sport_type):
 # ==============================================================================
 # PARSING METABOLICO (ESTRAZIONE MULTIPLA SMART)
 # ==============================================================================
+# Righe per blocco di lettura: l'header deve cadere nel primo blocco (si cerca nelle prime 300 righe)
+REPORT_CHUNK_ROWS = 50_000
+
+def _read_report_csv(raw_bytes, chunksize=REPORT_CHUNK_ROWS):
+    """
+    Legge un export CSV/TXT del metabolimetro come tabella di stringhe, a blocchi, con il parser C di pandas.
+    Separatore dedotto dalla prima riga (come faceva sep=None), ',' se non determinabile.
+    Il numero di colonne è fissato al massimo tra le righe: il preambolo può avere meno campi della tabella.
+    """
+    text = raw_bytes.decode('latin-1')
+    try:
+        sep = csv.Sniffer().sniff(text.split('\n', 1)[0]).delimiter
+    except csv.Error:
+        sep = ','
+    n_cols = max((line.count(sep) for line in text.splitlines()), default=0) + 1
+    return pd.read_csv(io.StringIO(text), header=None, sep=sep, names=range(n_cols), dtype=str, chunksize=chunksize)
+
 def parse_metabolic_report(uploaded_file):
+    # Ad ogni rerun Streamlit il file è lo stesso: il parsing è memorizzato sul contenuto
+    return _parse_metabolic_bytes(uploaded_file.getvalue(), uploaded_file.name)
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def _parse_metabolic_bytes(raw_bytes, filename):
     try:
         df_raw = None
-        uploaded_file.seek(0)
         
-        # 1. LEGGI TUTTO IL FILE (Scan & Slice)
-        if uploaded_file.name.lower().endswith(('.csv', '.txt')):
-            try:
-                df_raw = pd.read_csv(uploaded_file, header=None, sep=None, engine='python', encoding='latin-1', dtype=str)
-            except:
-                uploaded_file.seek(0)
-                df_raw = pd.read_csv(uploaded_file, header=None, sep=',', engine='python', encoding='latin-1', dtype=str)
-        elif uploaded_file.name.lower().endswith(('.xls', '.xlsx')):
-            df_raw = pd.read_excel(uploaded_file, header=None, dtype=str)
+        # 1. LEGGI IL FILE A BLOCCHI (Scan & Slice): header nel primo blocco, dati convertiti blocco per blocco
+        if filename.lower().endswith(('.csv', '.txt')):
+            chunks = _read_report_csv(raw_bytes)
+        elif filename.lower().endswith(('.xls', '.xlsx')):
+            chunks = iter([pd.read_excel(io.BytesIO(raw_bytes), header=None, dtype=str)])
         else:
             return None, None, "Formato non supportato."
+        df_raw = next(chunks, None)
 
         if df_raw is None or df_raw.empty: return None, None, "File vuoto."
 
@@ -276,18 +296,16 @@ def parse_metabolic_report(uploaded_file):
         targets = ["CHO", "FAT"]
         intensities = ["WR", "WATT", "POW", "FC", "HR", "BPM", "SPEED", "VEL", "KM/H", "V"]
 
-        for i, row in df_raw.head(300).iterrows():
-            row_text = " ".join([str(x).upper() for x in row.values if pd.notna(x)])
+        # itertuples: tuple semplici invece di una Series per riga; upper una volta sola per riga
+        for i, *values in df_raw.head(300).itertuples(name=None):
+            row_text = " ".join([str(x) for x in values if pd.notna(x)]).upper()
             if all(t in row_text for t in targets) and any(t in row_text for t in intensities):
                 header_idx = i; break
         
         if header_idx is None: return None, None, "Intestazione non trovata."
 
         # 3. TAGLIA E MAPPA
-        df_raw.columns = df_raw.iloc[header_idx] 
-        df = df_raw.iloc[header_idx + 1:].reset_index(drop=True)
-        df.columns = [str(c).strip().upper() for c in df.columns]
-        cols = df.columns.tolist()
+        cols = [str(c).strip().upper() for c in df_raw.iloc[header_idx]]
 
         def find_col(keys):
             for col in cols:
@@ -311,24 +329,33 @@ def parse_metabolic_report(uploaded_file):
             s = series.astype(str).str.replace(',', '.', regex=False).str.extract(r'(\d+\.?\d*)')[0]
             return pd.to_numeric(s, errors='coerce')
 
-        clean_df = pd.DataFrame()
-        clean_df['CHO'] = to_float(df[c_cho])
-        clean_df['FAT'] = to_float(df[c_fat])
+        # Colonna in uscita -> posizione nel file
+        col_pos = {'CHO': cols.index(c_cho), 'FAT': cols.index(c_fat)}
         
         available_metrics = []
         if c_watt: 
-            clean_df['Watt'] = to_float(df[c_watt])
+            col_pos['Watt'] = cols.index(c_watt)
             available_metrics.append('Watt')
         if c_hr: 
-            clean_df['HR'] = to_float(df[c_hr])
+            col_pos['HR'] = cols.index(c_hr)
             available_metrics.append('HR')
         if c_speed: 
-            clean_df['Speed'] = to_float(df[c_speed])
+            col_pos['Speed'] = cols.index(c_speed)
             available_metrics.append('Speed')
 
         if not available_metrics: return None, None, "Nessuna colonna intensità trovata."
 
-        clean_df.dropna(subset=['CHO', 'FAT'], inplace=True)
+        # Di ogni blocco restano solo le colonne mappate, già numeriche e senza righe vuote
+        def extract(block):
+            part = pd.DataFrame({name: to_float(block.iloc[:, pos]) for name, pos in col_pos.items()}, dtype=float)
+            return part.dropna(subset=['CHO', 'FAT'])
+
+        first_data_row = header_idx + 1
+        parts = [extract(df_raw.iloc[first_data_row:])]
+        del df_raw
+        parts.extend(extract(block) for block in chunks)
+        clean_df = pd.concat(parts)
+        clean_df.index = clean_df.index - first_data_row  # numerazione dalla prima riga dati, come prima
         
         # Check Unità (g/min -> g/h)
         if not clean_df.empty and clean_df['CHO'].max() < 8.0:
@@ -339,20 +366,31 @@ def parse_metabolic_report(uploaded_file):
     except Exception as e: return None, None, str(e)
 # --- ZWO ---
 def parse_zwo_file(uploaded_file, ftp_watts, thr_hr, sport_type):
+    # Come per il report metabolico: parsing memorizzato sul contenuto del file e sui parametri
+    return _parse_zwo_bytes(uploaded_file.getvalue(), ftp_watts, thr_hr, sport_type)
+
+@st.cache_data(show_spinner=False, max_entries=16)
+def _parse_zwo_bytes(raw_bytes, ftp_watts, thr_hr, sport_type):
     try:
-        xml_content = uploaded_file.getvalue().decode('utf-8')
-        root = ET.fromstring(xml_content)
-        intensity_series = [] 
-        total_duration_sec = 0
-        total_weighted_if = 0
-        for steady_state in root.findall('.//SteadyState'):
+        # Parsing in streaming: si leggono solo i blocchi SteadyState, liberati subito dopo
+        durations, powers = [], []
+        for _, elem in ET.iterparse(io.BytesIO(raw_bytes), events=('end',)):
+            if elem.tag != 'SteadyState': continue
+            attrib = elem.attrib
             try:
-                dur = int(steady_state.get('Duration'))
-                pwr = float(steady_state.get('Power'))
-                for _ in range(math.ceil(dur / 60)): intensity_series.append(pwr)
-                total_duration_sec += dur
-                total_weighted_if += pwr * (dur / 60) 
+                dur = int(attrib['Duration'])
+                pwr = float(attrib['Power'])
             except: continue
+            finally: elem.clear()
+            durations.append(dur)
+            powers.append(pwr)
+        durations = np.array(durations, dtype=np.int64)
+        powers = np.array(powers, dtype=float)
+        # Un valore per ogni minuto (anche parziale) di ciascun blocco
+        minutes_per_block = np.maximum(np.ceil(durations / 60), 0).astype(np.int64)
+        intensity_series = np.repeat(powers, minutes_per_block).tolist()
+        total_duration_sec = int(durations.sum())
+        total_weighted_if = float(np.dot(powers, durations / 60))
         total_min = math.ceil(total_duration_sec / 60)
         avg_val = 0
         if total_min > 0:
@@ -365,10 +403,27 @@ def parse_zwo_file(uploaded_file, ftp_watts, thr_hr, sport_type):
     except: return [], 0, 0, 0
 
 # --- ZONE ---
+# Coefficienti delle zone per unità di misura (W: % FTP, bpm: % FC soglia)
+_ZONE_COEFFS = {
+    "W": np.array([0.55, 0.75, 0.90, 1.05, 1.20]),
+    "bpm": np.array([0.85, 0.89, 0.94, 0.99, 1.02]),
+}
+_ZONE_LABELS = ("Z1", "Z2", "Z3", "Z4", "Z5")
+
+# Le soglie dipendono solo da FTP/FC soglia: in cache tra i rerun solo i numeri (tupla immutabile),
+# le righe della tabella sono ricostruite a ogni chiamata
+@lru_cache(maxsize=256)
+def _zone_thresholds(base, unit):
+    # Soglie troncate come int(base*p), calcolate in un'unica moltiplicazione vettoriale
+    return tuple((base * _ZONE_COEFFS[unit]).astype(np.int32).tolist())
+
+def _zone_rows(base, unit):
+    return [{"Zona": z, "Valore": f"{v} {unit}"} for z, v in zip(_ZONE_LABELS, _zone_thresholds(base, unit))]
+
 def calculate_zones_cycling(ftp):
-    return [{"Zona": f"Z{i+1}", "Valore": f"{int(ftp*p)} W"} for i, p in enumerate([0.55, 0.75, 0.90, 1.05, 1.20])]
+    return _zone_rows(ftp, "W")
 def calculate_zones_running_hr(thr):
-    return [{"Zona": f"Z{i+1}", "Valore": f"{int(thr*p)} bpm"} for i, p in enumerate([0.85, 0.89, 0.94, 0.99, 1.02])]
+    return _zone_rows(thr, "bpm")
 
 
 